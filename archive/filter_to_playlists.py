@@ -1,5 +1,35 @@
 import os
+import time
 import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import mutagen
+
+# ffmpeg settings for --format, e.g. to sync a smaller or iPod-friendly copy of the library:
+# (extension, codec as audio_codec names it, ffmpeg arguments)
+TRANSCODE_FORMATS = {
+    "alac": (".m4a", "alac", ["-c:a", "alac"]),
+    "aac": (".m4a", "aac", ["-c:a", "aac", "-b:a", "256k"]),
+    "mp3": (".mp3", "mp3", ["-c:a", "libmp3lame", "-b:a", "320k"]),
+    "flac": (".flac", "flac", ["-c:a", "flac"]),
+}
+
+def audio_codec(file_path):
+    """
+    Codec of a music file ("alac", "aac", "mp3", "flac", ...), read with mutagen, or None if it
+    can't be read. .m4a files can hold either ALAC or AAC, so the extension isn't enough.
+    """
+    try:
+        audio = mutagen.File(file_path)
+    except Exception:
+        return None
+    if audio is None:
+        return None
+    codec = getattr(audio.info, "codec", None)  # MP4: "alac" or "mp4a.40.2" (AAC)
+    if codec:
+        return "aac" if codec.startswith("mp4a") else codec.lower()
+    return type(audio).__name__.lower()  # FLAC, MP3, OggOpus, ...
 
 def resolve_music_file_path(source_dir, m3u_dir, line):
     """
@@ -11,23 +41,16 @@ def resolve_music_file_path(source_dir, m3u_dir, line):
     # Check if the line is an absolute path
     if os.path.isabs(line):
         return os.path.normpath(line)
-    
+
     # Otherwise, treat it as a relative path from the .m3u file's directory
     return os.path.normpath(os.path.join(m3u_dir, line))
 
-def copy_music_from_m3u(source_dir, target_dir):
+def collect_playlist_files(source_dir):
     """
-    Copies music files listed in .m3u files from the source directory
-    to the target directory.
-
-    Args:
-        source_dir (str): The path to the main folder containing .m3u files and music subfolders.
-        target_dir (str): The path to the folder where the music should be copied.
+    The union of the music files referenced by the .m3u files under source_dir,
+    as {path: number of playlist entries referring to it}, in the order first seen.
     """
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-
-    # Iterate through all files in the source directory
+    referenced = {}
     for root, _, files in os.walk(source_dir):
         for file in files:
             if file.endswith('.m3u'):
@@ -40,30 +63,133 @@ def copy_music_from_m3u(source_dir, target_dir):
                         line = line.strip()
                         if not line or line.startswith('#'):
                             continue
-
-                        # Resolve the file path
                         music_file_path = resolve_music_file_path(source_dir, root, line)
+                        referenced[music_file_path] = referenced.get(music_file_path, 0) + 1
+    return referenced
+
+def target_path_for(music_file_path, source_dir, target_dir, target_format=None):
+    """Where a file goes in the export, keeping the folder structure; transcoded files get the format's extension."""
+    rel_path = os.path.relpath(music_file_path, source_dir)
+    target_path = os.path.join(target_dir, rel_path)
+    if target_format:
+        extension = TRANSCODE_FORMATS[target_format][0]
+        if os.path.splitext(target_path)[1].lower() != extension:
+            target_path = os.path.splitext(target_path)[0] + extension
+    return target_path
+
+def is_up_to_date(music_file_path, target_path, target_format=None):
+    """
+    True if target_path already holds this file: for copies the same size and modification time,
+    for transcodes (target_format) a target in that codec that is newer than the source, so a
+    copy left by an earlier run without --format isn't taken for a transcode.
+    """
+    try:
+        target_stat = os.stat(target_path)
+    except OSError:
+        return False
+    source_stat = os.stat(music_file_path)
+    if target_format:
+        return (target_stat.st_mtime >= source_stat.st_mtime
+                and audio_codec(target_path) == TRANSCODE_FORMATS[target_format][1])
+    # copy2 keeps the modification time; allow a couple of seconds for FAT-formatted players
+    return target_stat.st_size == source_stat.st_size and abs(target_stat.st_mtime - source_stat.st_mtime) < 2
+
+def export_file(music_file_path, target_path, target_format=None):
+    """
+    Copy (or with target_format, transcode with ffmpeg) one file to target_path.
+    The file only appears at target_path once complete, so an interrupted export is never
+    mistaken for a finished file. Returns "copied" or "transcoded".
+    """
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    temp_path = target_path + ".part" + os.path.splitext(target_path)[1]  # ffmpeg picks the container from the extension
+    try:
+        if target_format:
+            subprocess.run(
+                ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", music_file_path,
+                 "-map", "0:a", "-map", "0:v?", "-c:v", "copy", "-disposition:v", "attached_pic",
+                 *TRANSCODE_FORMATS[target_format][2], temp_path],
+                check=True, capture_output=True, text=True,
+            )
+        else:
+            shutil.copy2(music_file_path, temp_path)
+        os.replace(temp_path, target_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return "transcoded" if target_format else "copied"
+
+def copy_music_from_m3u(source_dir, target_dir, workers=4, target_format=None):
+    """
+    Copies music files listed in .m3u files from the source directory
+    to the target directory.
+
+    Every file is exported once however many playlists list it, files already up to date
+    in the target are skipped, and the rest are copied by a pool of worker threads. Files that
+    would end up at the same target path are only exported once, from the first one listed.
+
+    Args:
+        source_dir (str): The path to the main folder containing .m3u files and music subfolders.
+        target_dir (str): The path to the folder where the music should be copied.
+        workers (int): Files exported at the same time.
+        target_format (str): A key of TRANSCODE_FORMATS to convert files to with ffmpeg, or None to copy them as they are.
+    """
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    start = time.perf_counter()
+    referenced = collect_playlist_files(source_dir)
+    print(f"{sum(referenced.values())} playlist entries refer to {len(referenced)} files")
+
+    counts = {}
+    jobs = {}
+    targets = {}  # Target path: the source exported there
+    for music_file_path in referenced:
+        if not os.path.exists(music_file_path):
+            print(f"File not found: {music_file_path}")
+            counts["missing"] = counts.get("missing", 0) + 1
+            continue
+        target_path = target_path_for(music_file_path, source_dir, target_dir, target_format)
+        # e.g. "Song.wav" and "Song.flac" both become "Song.flac" with --format flac; the first one listed is kept
+        target_key = os.path.normcase(target_path)
+        if target_key in targets:
+            print(f"Skipped: {music_file_path} would overwrite {target_path}, exported from {targets[target_key]}")
+            counts["skipped"] = counts.get("skipped", 0) + 1
+            continue
+        targets[target_key] = music_file_path
+        # Files already in the target codec are copied as they are
+        transcode = target_format if target_format and \
+            audio_codec(music_file_path) != TRANSCODE_FORMATS[target_format][1] else None
+        if is_up_to_date(music_file_path, target_path, transcode):
+            counts["up to date"] = counts.get("up to date", 0) + 1
+            continue
+        jobs[music_file_path] = (target_path, transcode)
 
-                        print(f"Resolved path: {music_file_path}")
+    if any(transcode for _, transcode in jobs.values()) and shutil.which("ffmpeg") is None:
+        raise SystemExit("ffmpeg is needed to transcode; install it or leave out --format")
 
-                        if os.path.exists(music_file_path):
-                            # Ensure the target folder structure is preserved
-                            rel_path = os.path.relpath(music_file_path, source_dir)
-                            target_path = os.path.join(target_dir, rel_path)
-                            target_folder = os.path.dirname(target_path)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(export_file, src, target, transcode): src
+                   for src, (target, transcode) in jobs.items()}
+        for future in as_completed(futures):
+            music_file_path = futures[future]
+            try:
+                result = future.result()
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"Failed: {music_file_path}: {getattr(e, 'stderr', None) or e}")
+                result = "failed"
+            else:
+                print(f"{result.capitalize()}: {music_file_path} -> {jobs[music_file_path][0]}")
+            counts[result] = counts.get(result, 0) + 1
 
-                            # Create target folders if they don't exist
-                            if not os.path.exists(target_folder):
-                                os.makedirs(target_folder)
-                            
-                            # Copy the file to the target location
-                            shutil.copy2(music_file_path, target_path)
-                            print(f"Copied: {music_file_path} -> {target_path}")
-                        else:
-                            print(f"File not found: {music_file_path}")
+    summary = ", ".join(f"{count} {result}" for result, count in sorted(counts.items()))
+    print(f"Done in {time.perf_counter() - start:.1f} s ({summary or 'no files'})")
 
 if __name__ == "__main__":
-    # Input paths from the user
-    source_dir = '/Users/calebmueller/Library/CloudStorage/OneDrive-UNBC/Music/ALAC iPod Music'
-    target_dir = '/Users/calebmueller/Desktop/Filtered ALAC'
-    copy_music_from_m3u(source_dir, target_dir)
+    parser = argparse.ArgumentParser(description="Copy the music listed in .m3u playlists to another folder.")
+    parser.add_argument("source_dir", nargs="?",
+                        default='/Users/calebmueller/Library/CloudStorage/OneDrive-UNBC/Music/ALAC iPod Music')
+    parser.add_argument("target_dir", nargs="?", default='/Users/calebmueller/Desktop/Filtered ALAC')
+    parser.add_argument("--workers", type=int, default=4, help="Files exported at the same time")
+    parser.add_argument("--format", choices=sorted(TRANSCODE_FORMATS), help="Transcode to this format with ffmpeg")
+    args = parser.parse_args()
+    copy_music_from_m3u(args.source_dir, args.target_dir, args.workers, args.format)
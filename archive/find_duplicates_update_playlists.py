@@ -1,8 +1,16 @@
 import os
 import re
+import hashlib
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 from tkinter import Tk
 from tkinter.filedialog import askdirectory
+import mutagen
+
+MUSIC_EXTENSIONS = ('.m4a', '.mp3', '.flac', '.aac', '.wav', '.opus')
+PARTIAL_HASH_BYTES = 64 * 1024  # Read from each end of a file before hashing all of it
 
 def remove_leading_numbers(file_name):
     """
@@ -10,68 +18,280 @@ def remove_leading_numbers(file_name):
     """
     return re.sub(r"^\d+\.\s*", "", file_name)
 
-def update_artist_folders(main_folder):
+def relative_path(path, main_folder):
+    """Path relative to main_folder with '/' separators, as used in the path mapping."""
+    return os.path.relpath(path, main_folder).replace(os.sep, '/')
+
+def content_hash(file_path, partial=False):
+    """
+    blake2b of the file contents. partial only hashes the first and last PARTIAL_HASH_BYTES,
+    which is enough to tell most files of the same size apart without reading them.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        if partial:
+            digest.update(f.read(PARTIAL_HASH_BYTES))
+            f.seek(max(0, os.fstat(f.fileno()).st_size - PARTIAL_HASH_BYTES))
+            digest.update(f.read(PARTIAL_HASH_BYTES))
+        else:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def audio_quality(file_path):
+    """
+    (length in seconds, quality) of a music file. Quality tuples compare higher for better
+    copies: lossless first, then bitrate, sample rate and bit depth.
+    """
+    try:
+        info = mutagen.File(file_path).info
+    except Exception:
+        return None, (False, 0, 0, 0)
+    lossless = (os.path.splitext(file_path)[1].lower() in ('.flac', '.wav')
+                or str(getattr(info, 'codec', '')).startswith('alac'))
+    return getattr(info, 'length', None), (lossless, getattr(info, 'bitrate', 0) or 0,
+                                           getattr(info, 'sample_rate', 0) or 0,
+                                           getattr(info, 'bits_per_sample', 0) or 0)
+
+def groups_of(items, key):
+    """Lists of items sharing key(item), for keys shared by more than one item."""
+    groups = collections.defaultdict(list)
+    for item in items:
+        groups[key(item)].append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+def best_copy_first(group, quality):
+    """Sort group so the copy to keep comes first: best quality, then a name without leading numbers, then the shortest path."""
+    group.sort(key=lambda path: (quality[path][1], remove_leading_numbers(os.path.basename(path))
+                                 == os.path.basename(path), -len(path)), reverse=True)
+    return group[0], group[1:]
+
+def find_duplicates(main_folder, workers=8, tolerance=1.0):
     """
-    Process all artist folders to remove leading numbers from song files.
+    Find copies of the same track under main_folder.
+
+    identical: files whose contents are identical (same size, then same first and last 64 KB,
+    then same full hash, so only files that could match are read). These are safe to remove.
+    similar: files in the same folder with the same name once leading numbers and the
+    extension are removed, and lengths all within tolerance seconds of each other (e.g.
+    "01. Song.mp3" and "Song.flac"). These are only likely the same recording; a remaster,
+    live take or different edit can look the same.
+    Hashes and tags are read on a thread pool.
+    Returns (identical, similar), each [(file to keep, [other copies])] with the best quality copy kept.
     """
+    sizes = {}
+    for root, _, files in os.walk(main_folder):
+        if root == main_folder:
+            continue  # Only files in the artist folders; the mapping's paths need a folder to be told apart
+        for file_name in files:
+            if file_name.lower().endswith(MUSIC_EXTENSIONS):
+                file_path = os.path.join(root, file_name)
+                sizes[file_path] = os.path.getsize(file_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        same_size = [path for group in groups_of(sizes, sizes.get) for path in group]
+        partial = dict(zip(same_size, executor.map(lambda path: content_hash(path, partial=True), same_size)))
+        same_partial = [path for group in groups_of(same_size, lambda path: (sizes[path], partial[path]))
+                        for path in group]
+        # Files no bigger than the two partial chunks were hashed whole already
+        needs_full = [path for path in same_partial if sizes[path] > 2 * PARTIAL_HASH_BYTES]
+        full = dict(zip(needs_full, executor.map(content_hash, needs_full)))
+        identical_groups = groups_of(same_partial, lambda path: (sizes[path], partial[path], full.get(path)))
+
+        same_name = groups_of(sizes, lambda path: (os.path.dirname(path), os.path.splitext(
+            remove_leading_numbers(os.path.basename(path)))[0].lower()))
+        candidates = {path for group in same_name + identical_groups for path in group}
+        quality = dict(zip(candidates, executor.map(audio_quality, candidates)))
+
+    identical = [best_copy_first(group, quality) for group in identical_groups]
+    identical_copies = {path for _, others in identical for path in others}
+
+    similar = []
+    for group in same_name:
+        # Copies that go anyway as identical to another file are left out; the rest are split into
+        # clusters whose lengths are all within tolerance of the cluster's shortest file
+        timed = sorted((quality[path][0], path) for path in group
+                       if quality[path][0] is not None and path not in identical_copies)
+        clusters = []
+        for length, path in timed:
+            if clusters and length - clusters[-1][0][0] <= tolerance:
+                clusters[-1].append((length, path))
+            else:
+                clusters.append([(length, path)])
+        similar.extend(best_copy_first([path for _, path in cluster], quality)
+                       for cluster in clusters if len(cluster) > 1)
+    return identical, similar
+
+def update_artist_folders(main_folder, workers=8, dry_run=False, remove_similar=False):
+    """
+    Remove duplicate tracks, keeping the best copy of each, then remove leading numbers
+    from the remaining song files in the artist folders.
+    Only byte-identical copies are removed, unless remove_similar is set; files that just share
+    a name and length are reported so they can be checked by ear.
+    Returns the mapping {old path: new path} (relative to main_folder) for the playlists.
+    """
+    removed = {}  # Removed copy: the copy kept instead
+    renames = {}
+    identical, similar = find_duplicates(main_folder, workers)
+    for keep, others in identical:
+        for other in others:
+            print(f"Duplicate: {other} (keeping {keep})")
+            removed[other] = keep
+    for keep, others in similar:
+        for other in others:
+            if remove_similar:
+                print(f"Likely duplicate: {other} (keeping {keep})")
+                removed[other] = keep
+            else:
+                print(f"Possible duplicate, not removed: {other} has the same name and length as {keep} "
+                      f"but different contents")
+    if not dry_run:
+        for other in removed:
+            os.remove(other)
+
     for artist_folder in os.listdir(main_folder):
         artist_path = os.path.join(main_folder, artist_folder)
         if os.path.isdir(artist_path):
-            seen_files = set()
-            for file_name in os.listdir(artist_path):
+            names = set(os.listdir(artist_path)) - {os.path.basename(path) for path in removed
+                                                    if os.path.dirname(path) == artist_path}
+            for file_name in sorted(names):
                 old_path = os.path.join(artist_path, file_name)
                 if os.path.isfile(old_path):
                     new_name = remove_leading_numbers(file_name)
-                    if new_name not in seen_files:
-                        seen_files.add(new_name)
-                        new_path = os.path.join(artist_path, new_name)
+                    if new_name == file_name:
+                        continue
+                    if new_name in names:
+                        # Another file already has the name (a different track, or a similar copy that was kept)
+                        print(f"Not renaming {old_path}: {new_name} is another file")
+                        continue
+                    new_path = os.path.join(artist_path, new_name)
+                    if not dry_run:
                         os.rename(old_path, new_path)
-                    else:
-                        os.remove(old_path)
+                    names.discard(file_name)
+                    names.add(new_name)
+                    renames[old_path] = new_path
 
-def update_m3u_files(main_folder):
+    # Removed duplicates point straight at the final name of the copy that was kept: an identical
+    # copy's keeper can itself go as a similar copy, and renames don't chain (a new name has no
+    # leading numbers). A kept "01. Song.mp3" renamed to the removed "Song.mp3"'s name leaves
+    # that entry pointing at itself, so it is left out.
+    mapping = {}
+    for old, new in list(removed.items()) + list(renames.items()):
+        seen = {old}
+        while new in removed and new not in seen:
+            seen.add(new)
+            new = removed[new]
+        new = renames.get(new, new)
+        if new != old:
+            mapping[relative_path(old, main_folder)] = relative_path(new, main_folder)
+    return mapping
+
+def map_playlist_path(path, mapping):
     """
-    Update all .m3u playlist files in the main folder to reflect updated paths.
+    Apply mapping to a playlist entry. Entries can be relative or point into another copy of
+    the library (e.g. Jellyfin's), so the longest trailing part of the path that is in the
+    mapping is replaced, keeping the entry's own prefix and separator.
     """
-    for root, _, files in os.walk(main_folder):
-        for file_name in files:
-            if isinstance(file_name, str) and file_name.endswith(".m3u"):
-                m3u_path = os.path.join(root, file_name)
-                updated_lines = []
-                with open(m3u_path, 'r', encoding='utf-8') as m3u_file:
-                    for line in m3u_file:
-                        if line.strip() and not line.startswith("#"):
-                            parts = line.strip().split(os.sep)
-                            parts[-1] = remove_leading_numbers(parts[-1])
-                            updated_lines.append(os.path.join(*parts) + "\n")
-                        else:
-                            updated_lines.append(line)
-                with open(m3u_path, 'w', encoding='utf-8') as m3u_file:
-                    m3u_file.writelines(updated_lines)
-
-def update_xml_files(main_folder):
+    separator = '\\' if '\\' in path and '/' not in path else '/'
+    parts = path.replace('\\', '/').split('/')
+    for start in range(len(parts) - 1):  # At least the folder and the file name, never a bare file name
+        new = mapping.get('/'.join(parts[start:]))
+        if new is not None:
+            return separator.join(parts[:start] + new.split('/'))
+    return path
+
+def replace_file(file_path, write):
+    """Have write(temp_path) write the new contents, then swap them in, so a playlist is never left half written."""
+    temp_path = file_path + ".tmp"
+    try:
+        write(temp_path)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def update_m3u_file(m3u_path, mapping):
+    """Update the entries of one .m3u playlist. Returns whether anything changed."""
+    updated_lines = []
+    changed = False
+    with open(m3u_path, 'r', encoding='utf-8', newline='') as m3u_file:
+        for line in m3u_file:
+            entry = line.strip()
+            if entry and not entry.startswith("#"):
+                new_entry = map_playlist_path(entry, mapping)
+                if new_entry != entry:
+                    line = new_entry + line[len(line.rstrip('\r\n')):]  # Keep the line ending
+                    changed = True
+            updated_lines.append(line)
+    if changed:
+        def write(temp_path):
+            with open(temp_path, 'w', encoding='utf-8', newline='') as m3u_file:
+                m3u_file.writelines(updated_lines)
+        replace_file(m3u_path, write)
+    return changed
+
+def update_xml_file(xml_path, mapping):
+    """Update the entries of one .xml playlist. Returns whether anything changed."""
+    tree = ET.parse(xml_path)
+    changed = False
+    for playlist_item in tree.getroot().findall(".//PlaylistItem"):
+        path = playlist_item.find("Path")
+        if path is not None and isinstance(path.text, str):
+            new_path = map_playlist_path(path.text, mapping)
+            if new_path != path.text:
+                path.text = new_path
+                changed = True
+    if changed:
+        replace_file(xml_path, lambda temp_path: tree.write(temp_path, encoding='utf-8', xml_declaration=True))
+    return changed
+
+def update_playlists(main_folder, mapping, workers=8):
     """
-    Update all .xml playlist files in the main folder to reflect updated paths.
+    Update all .m3u and .xml playlist files in the main folder to reflect updated paths.
+    The folder is walked once and the playlists are updated on a thread pool; only
+    playlists with an entry in the mapping are rewritten.
     """
-    for root, _, files in os.walk(main_folder):
-        for file_name in files:
-            if isinstance(file_name, str) and file_name.endswith(".xml"):
-                xml_path = os.path.join(root, file_name)
-                tree = ET.parse(xml_path)
-                root = tree.getroot()
-                for playlist_item in root.findall(".//PlaylistItem"):
-                    path = playlist_item.find("Path")
-                    if path is not None and isinstance(path.text, str):
-                        parts = path.text.split(os.sep)
-                        parts[-1] = remove_leading_numbers(parts[-1])
-                        path.text = os.path.join(*parts)
-                tree.write(xml_path, encoding='utf-8', xml_declaration=True)
+    if not mapping:
+        print("No paths changed, playlists left as they are")
+        return 0
+    updaters = {".m3u": update_m3u_file, ".xml": update_xml_file}
+    playlists = [
+        os.path.join(folder, file_name)
+        for folder, _, files in os.walk(main_folder)
+        for file_name in files if os.path.splitext(file_name)[1].lower() in updaters
+    ]
+
+    def update(playlist_path):
+        try:
+            return updaters[os.path.splitext(playlist_path)[1].lower()](playlist_path, mapping)
+        except (OSError, ET.ParseError, UnicodeDecodeError) as e:
+            print(f"Could not update {playlist_path}: {e}")
+            return False
+
+    changed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for playlist_path, was_changed in zip(playlists, executor.map(update, playlists)):
+            if was_changed:
+                print(f"Updated {playlist_path}")
+                changed += 1
+    print(f"{changed} of {len(playlists)} playlists updated")
+    return changed
 
 def main():
+    parser = argparse.ArgumentParser(description="Remove duplicate tracks and leading numbers, then update the playlists.")
+    parser.add_argument("main_folder", nargs="?", help="Music folder (asks with a dialog if left out)")
+    parser.add_argument("--workers", type=int, default=8, help="Threads hashing files and reading tags")
+    parser.add_argument("--dry-run", action="store_true", help="Only report duplicates and renames")
+    parser.add_argument("--remove-similar", action="store_true",
+                        help="Also remove files that only share a name and length with a better copy "
+                             "(by default only byte-identical copies are removed)")
+    args = parser.parse_args()
 
-    Tk().withdraw()  # Hide the main Tkinter window
-    print("Select the folder containing the music files:")
-    main_folder = askdirectory(title="Select Input Folder")
+    main_folder = args.main_folder
+    if not main_folder:
+        Tk().withdraw()  # Hide the main Tkinter window
+        print("Select the folder containing the music files:")
+        main_folder = askdirectory(title="Select Input Folder")
     if not main_folder:
         print("No input folder selected. Exiting.")
         exit()
@@ -82,15 +302,14 @@ def main():
     
     # Update artist folders
     print("Processing artist folders...")
-    update_artist_folders(main_folder)
-    
-    # Update .m3u files
-    print("Updating .m3u playlist files...")
-    update_m3u_files(main_folder)
+    mapping = update_artist_folders(main_folder, args.workers, args.dry_run, args.remove_similar)
+    print(f"{len(mapping)} files removed or renamed")
+    if args.dry_run:
+        return
     
-    # Update .xml files
-    print("Updating .xml playlist files...")
-    update_xml_files(main_folder)
+    # Update .m3u and .xml files
+    print("Updating playlist files...")
+    update_playlists(main_folder, mapping, args.workers)
     
     print("Processing completed!")
 
@@ -1,11 +1,22 @@
-#update
+#reconciles Jellyfin playlist XMLs with the music database folder: every entry is looked up in an index
+#built once from the library catalog (file name, then artist/title tags, then a trigram fuzzy match on
+#the title, with the artist checked when the entry names one) and pointed at the file it resolves to;
+#only playlists that change are rewritten
+#usage: python check_xml.py [xml folder] [music folder] [--jellyfin-path PATH] [--workers N] [--min-score 0.6] [--dry-run]
+
 import os
 import re
+import math
+import time
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
+from library_catalog import LibraryCatalog, DEFAULT_CATALOG_PATH, normalize_filename
 
-def normalize_filename(filename):
-    """Remove artist prefix like 'Artist - ' for normalization purposes."""
-    return re.sub(r'^[^/\\]* -  ', '', filename).lower()
+DEFAULT_XML_FOLDER = 'C:/Users/Caleb/Desktop/m3u/XML Playlists'
+DEFAULT_MUSIC_FOLDER = 'C:/Users/Caleb/Desktop/Rachel_Music'
+DEFAULT_JELLYFIN_PATH = '/data/rachels_music'  # The music folder as Jellyfin sees it
 
 def parse_xml_playlist(xml_file):
     """Extract playlist items and their full paths from an XML file."""
@@ -20,12 +31,211 @@ def parse_xml_playlist(xml_file):
         print(f"Error processing {xml_file}: {e}")
         return None, None, []
 
-def update_playlist_item(path_element, new_filename):
-    """Update the Path element in the XML with the new filename."""
-    directory = os.path.dirname(path_element.text)
-    path_element.text = os.path.join(directory, new_filename)
+def update_playlist_item(path_element, new_path):
+    """Update the Path element in the XML with the new path."""
+    path_element.text = new_path
+
+def xml_declaration(xml_file):
+    """The file's XML declaration (ElementTree drops it when parsing), or Jellyfin's usual one."""
+    with open(xml_file, 'r', encoding='utf-8') as f:
+        first_line = f.readline().strip()
+    if first_line.startswith('<?xml'):
+        return first_line[:first_line.index('?>') + 2]
+    return '<?xml version="1.0" encoding="utf-8" standalone="yes"?>'
+
+def match_key(text):
+    """Lowercase words of text without punctuation, so 'Don't Stop (Live)' and 'dont stop live' compare alike."""
+    text = re.sub(r"['\u2019]", "", text or "").lower()
+    return " ".join(re.sub(r"[\W_]+", " ", text).split())
+
+def split_name(filename):
+    """
+    (artist, title) guessed from a file name like '01. Artist - Title.mp3'; leading track numbers
+    are ignored and artist is '' if there's no ' - '.
+    """
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    stem = re.sub(r"^\d{1,3}(?:[\s._-]+)(?=\S)", "", stem)
+    parts = re.split(r"\s+-\s+", stem, maxsplit=1)
+    if len(parts) == 2:
+        return match_key(parts[0]), match_key(parts[1])
+    return "", match_key(stem)
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class PlaylistIndex:
+    """
+    Lookup tables over catalog rows for resolving playlist entries.
+
+    Exact lookups go by normalized file name, then (artist, title) and title alone, taken from
+    the tags or, for untagged files, the file name. Entries that match none of those are compared
+    against every distinct title through an inverted trigram index, so only titles sharing
+    trigrams with the entry are scored.
+
+    When an entry names its artist (an 'Artist - ' prefix, or else a folder named after a known
+    artist) a file only matches if one of its artists agrees: the artist tag, the prefix of
+    its own name, or a folder it is in under music_folder.
+
+    There is no length key: Jellyfin's playlist.xml only records each entry's path, so an entry
+    has no length to look up. Several equally good files are told apart by extension and path.
+    """
+
+    def __init__(self, records, music_folder, min_score=0.6):
+        self.records = records
+        self.min_score = min_score
+        self.relative_paths = []  # Path of each record relative to music_folder, with '/' separators
+        self.record_artists = []  # Artist keys each record answers to
+        self.artists = set()
+        self.by_name = collections.defaultdict(list)
+        self.by_tags = collections.defaultdict(list)
+        self.by_title = collections.defaultdict(list)
+        self.title_grams = {}  # title -> number of trigrams
+        self.postings = collections.defaultdict(list)  # trigram -> titles containing it
+
+        for i, record in enumerate(records):
+            relative_path = os.path.relpath(record['path'], music_folder).replace(os.sep, '/')
+            self.relative_paths.append(relative_path)
+            self.by_name[record['norm_name']].append(i)
+            name_artist, name_title = split_name(record['path'])
+            title = match_key(record['title']) or name_title
+            artist = match_key(record['artist']) or name_artist
+            artists = {artist, name_artist, *(match_key(folder) for folder in relative_path.split('/')[:-1])}
+            artists.discard("")
+            self.record_artists.append(artists)
+            self.artists |= artists
+            if not title:
+                continue
+            self.by_tags[(artist, title)].append(i)
+            if title not in self.by_title:
+                grams = trigrams(title)
+                self.title_grams[title] = len(grams)
+                for gram in grams:
+                    self.postings[gram].append(title)
+            self.by_title[title].append(i)
+
+    def entry_artists(self, entry_path):
+        """
+        Artist keys a playlist entry names: its 'Artist - ' prefix, or without one, the folders
+        in its path that are known artists.
+        """
+        parts = entry_path.replace('\\', '/').split('/')
+        name_artist = split_name(parts[-1])[0]
+        if name_artist:
+            return {name_artist}
+        return {folder for folder in map(match_key, parts[:-1]) if folder in self.artists}
+
+    def agreeing(self, ids, artists):
+        """The ids whose files agree with the entry's artists (all of them if the entry names none)."""
+        if not ids or not artists:
+            return ids
+        return [i for i in ids if self.record_artists[i] & artists]
+
+    def fuzzy_titles(self, title, artists=()):
+        """
+        (score, title) of the indexed title most like title (Dice coefficient of trigrams) that has
+        a file agreeing with artists, or (0, None).
+        """
+        grams = sorted(trigrams(title), key=lambda gram: len(self.postings.get(gram, ())))
+        # A title scoring at least min_score shares at least needed trigrams with this one, so it has
+        # to contain one of the rarest len(grams) - needed + 1; only titles found through those are scored
+        needed = max(1, math.ceil(self.min_score * len(grams) / (2 - self.min_score)))
+        rare = len(grams) - needed + 1
+        shared = collections.Counter()
+        for gram in grams[:rare]:
+            shared.update(self.postings.get(gram, ()))
+
+        best = (0.0, None)
+        query = set(grams)
+        common = len(grams) - rare
+        for candidate, count in shared.most_common():
+            # Skip titles that couldn't beat the best so far even if they had all the common trigrams
+            bound = 2 * (count + common) / (len(query) + self.title_grams[candidate])
+            if bound < max(best[0], self.min_score) or (bound == best[0] and candidate > best[1]):
+                continue
+            candidate_grams = trigrams(candidate)
+            score = 2 * len(query & candidate_grams) / (len(query) + len(candidate_grams))
+            if (score > best[0] or (score == best[0] and candidate < best[1])) and \
+                    self.agreeing(self.by_title[candidate], artists):
+                best = (score, candidate)
+        return best
+
+    def pick(self, ids, filename):
+        """Best of several candidate rows: same extension as the entry, then the first path."""
+        extension = os.path.splitext(filename)[1].lower()
+
+        def rank(i):
+            record = self.records[i]
+            return (
+                os.path.splitext(record['path'])[1].lower() != extension,
+                record['path'],
+            )
+        return min(ids, key=rank)
 
-def process_xml_playlists(xml_folder, music_database_dir):
+    def resolve(self, entry_path):
+        """
+        Find the library file for a playlist entry.
+        Returns (index of the catalog row, how it matched, score), or (None, "unresolved", best fuzzy score).
+        """
+        filename = os.path.basename(entry_path.replace('\\', '/'))
+        artist, title = split_name(filename)
+        artists = self.entry_artists(entry_path)
+        for how, ids in (("name", self.by_name.get(normalize_filename(filename))),
+                         ("tags", self.by_tags.get((artist, title))),
+                         ("title", self.by_title.get(title))):
+            ids = self.agreeing(ids, artists)
+            if ids:
+                return self.pick(ids, filename), how, 1.0
+
+        score, candidate = self.fuzzy_titles(title, artists) if title else (0.0, None)
+        if candidate and score >= self.min_score:
+            return self.pick(self.agreeing(self.by_title[candidate], artists), filename), "fuzzy", score
+        return None, "unresolved", score
+
+def reconcile_playlist(xml_file, index, jellyfin_path, dry_run=False):
+    """
+    Point every entry of one playlist at the file it resolves to: the file's place in the
+    music folder, under jellyfin_path (the music folder as Jellyfin sees it).
+    Saves the playlist (through a temporary file, keeping its XML declaration) only if a path changed.
+    Returns (report lines, whether the playlist changed, counts by kind of match).
+    """
+    lines = [f"\nProcessing playlist: {xml_file}"]
+    counts = collections.Counter()
+    tree, root, playlist_items = parse_xml_playlist(xml_file)
+    if not tree or not playlist_items:
+        return lines, False, counts
+
+    changes_made = False
+    for path_element in playlist_items:
+        if path_element is None or not path_element.text:
+            continue
+        original_path = path_element.text
+
+        match, how, score = index.resolve(original_path)
+        counts[how] += 1
+        if match is None:
+            lines.append(f"No match found (best {score:.2f}): {original_path}")
+            continue
+        new_path = f"{jellyfin_path}/{index.relative_paths[match]}"
+        if new_path != original_path:
+            update_playlist_item(path_element, new_path)
+            lines.append(f"Match found ({how}, {score:.2f}): {original_path} -> {new_path}")
+            changes_made = True
+
+    if changes_made and not dry_run:
+        # Save changes back to the XML file
+        temp_path = xml_file + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(xml_declaration(xml_file) + "\n" + ET.tostring(root, encoding="unicode") + "\n")
+        os.replace(temp_path, xml_file)
+        lines.append(f"Saved changes to {xml_file}")
+    elif not changes_made:
+        lines.append("No changes made to this playlist.")
+    return lines, changes_made, counts
+
+def process_xml_playlists(xml_folder, music_database_dir, workers=4, min_score=0.6, dry_run=False,
+                          catalog_path=DEFAULT_CATALOG_PATH, jellyfin_path=DEFAULT_JELLYFIN_PATH):
+    start = time.perf_counter()
     # Collect all XML files
     xml_files = [
         os.path.join(subdir, file)
@@ -33,50 +243,43 @@ def process_xml_playlists(xml_folder, music_database_dir):
         for file in files if file.endswith(".xml")
     ]
 
-    # Collect all music database files
-    database_files = [
-        os.path.join(subdir, file)
-        for subdir, _, files in os.walk(music_database_dir)
-        for file in files
-    ]
-
-    # Normalize database filenames for comparison
-    normalized_database_files = {
-        normalize_filename(os.path.basename(file)): file for file in database_files
-    }
+    # Music database files come from the library catalog and are indexed once for all playlists
+    catalog = LibraryCatalog(catalog_path)
+    catalog.refresh(music_database_dir)
+    index = PlaylistIndex(catalog.files(music_database_dir), music_database_dir, min_score)
+    catalog.close()
+    print(f"Indexed {len(index.records)} files, {len(index.by_title)} titles "
+          f"in {time.perf_counter() - start:.2f} s")
 
-    for xml_file in xml_files:
-        print(f"\nProcessing playlist: {xml_file}")
-        tree, root, playlist_items = parse_xml_playlist(xml_file)
-        if not tree or not playlist_items:
-            continue
-
-        changes_made = False
+    totals = collections.Counter()
+    changed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map keeps the playlists' reports in order while they are worked on concurrently
+        for lines, changes_made, counts in executor.map(
+                lambda xml_file: reconcile_playlist(xml_file, index, jellyfin_path.rstrip('/'), dry_run), xml_files):
+            print("\n".join(lines))
+            totals.update(counts)
+            changed += changes_made
 
-        for path_element in playlist_items:
-            original_path = path_element.text
-            original_filename = os.path.basename(original_path)
-            normalized_original = normalize_filename(original_filename)
+    summary = ", ".join(f"{count} {how}" for how, count in sorted(totals.items()))
+    print(f"\n{changed} of {len(xml_files)} playlists {'would change' if dry_run else 'changed'} "
+          f"({summary or 'no entries'}) in {time.perf_counter() - start:.2f} s")
 
-            # Check for a match in the database
-            if normalized_original in normalized_database_files:
-                print(f"Match found: {original_path} -> {normalized_database_files[normalized_original]}")
-            else:
-                # Normalize to {title}.extension while retaining original directory
-                normalized_filename = re.sub(r'^[^/\\]* -  ', '', original_filename)
-                update_playlist_item(path_element, normalized_filename)
-                print(f"No match found. Normalized: {original_filename} -> {normalized_filename}")
-                changes_made = True
-
-        # Save changes back to the XML file
-        if changes_made:
-            tree.write(xml_file)
-            print(f"Saved changes to {xml_file}")
-        else:
-            print("No changes made to this playlist.")
+def main():
+    parser = argparse.ArgumentParser(description="Point Jellyfin playlist entries at the files in the music folder.")
+    parser.add_argument("xml_folder", nargs="?", default=DEFAULT_XML_FOLDER, help="Folder with the playlist XMLs")
+    parser.add_argument("music_folder", nargs="?", default=DEFAULT_MUSIC_FOLDER, help="Music database folder")
+    parser.add_argument("--jellyfin-path", default=DEFAULT_JELLYFIN_PATH,
+                        help="Music folder as Jellyfin sees it; matched entries are rewritten under it")
+    parser.add_argument("--workers", type=int, default=4, help="Playlists processed at the same time")
+    parser.add_argument("--min-score", type=float, default=0.6,
+                        help="Lowest trigram similarity (0-1) accepted for a fuzzy match")
+    parser.add_argument("--dry-run", action="store_true", help="Report the changes without saving them")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="SQLite catalog file")
+    args = parser.parse_args()
 
+    process_xml_playlists(args.xml_folder, args.music_folder, args.workers, args.min_score, args.dry_run,
+                          args.catalog, args.jellyfin_path)
 
-# Path to the folder containing XML files and the music database directory
-xml_folder_path = 'C:/Users/Caleb/Desktop/m3u/XML Playlists'
-music_database_path = 'C:/Users/Caleb/Desktop/Rachel_Music'
-process_xml_playlists(xml_folder_path, music_database_path)
+if __name__ == "__main__":
+    main()
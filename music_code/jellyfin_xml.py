@@ -0,0 +1,150 @@
+#writes Jellyfin playlist.xml files in one pass, without building the document in memory
+#output matches the old ElementTree + minidom toprettyxml round-trip byte for byte
+#usage: python jellyfin_xml.py benchmark [--items N]
+
+import os
+import time
+import argparse
+import itertools
+import collections
+import tempfile
+from datetime import datetime
+import xml.etree.ElementTree as ET
+
+def escape(text):
+    """Escape text content the way minidom does."""
+    return (text.replace("&", "&amp;").replace("<", "&lt;")
+            .replace("\"", "&quot;").replace(">", "&gt;"))
+
+def element(name, text, indent):
+    """One indented element on its own line; empty elements are written as <Name/>."""
+    if not text:
+        return f"{indent}<{name}/>\n"
+    return f"{indent}<{name}>{escape(str(text))}</{name}>\n"
+
+def playlist_metadata(tracks, max_genres=5):
+    """
+    RunningTime and Genres for a playlist from its tracks' catalog rows (see library_catalog).
+
+    RunningTime is the total length in whole minutes, which is how Jellyfin stores it; genres
+    are the most common ones among the tracks. Returns ("", []) if no track has a length.
+    """
+    total_seconds = 0.0
+    genre_counts = collections.Counter()
+    for track in tracks:
+        total_seconds += track.get("duration") or 0
+        if track.get("genre"):
+            genre_counts[track["genre"]] += 1
+    running_time = str(round(total_seconds / 60)) if total_seconds else ""
+    return running_time, [genre for genre, _ in genre_counts.most_common(max_genres)]
+
+def write_playlist_xml(output_path, title, paths, running_time="", genres=(), owner="", added=None):
+    """
+    Write a Jellyfin playlist.xml listing paths.
+
+    paths can be any iterable (e.g. a generator over the lines of an .m3u) and is only
+    read once, so memory use doesn't depend on the size of the playlist.
+    Returns the number of playlist items written.
+    """
+    if added is None:
+        added = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
+
+    count = 0
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n<Item>\n')
+        f.write(element("Added", added, "  "))
+        f.write(element("LockData", "false", "  "))
+        f.write(element("LocalTitle", title, "  "))
+        f.write(element("RunningTime", running_time, "  "))
+
+        genres = list(genres)
+        if genres:
+            f.write("  <Genres>\n")
+            for genre in genres:
+                f.write(element("Genre", genre, "    "))
+            f.write("  </Genres>\n")
+        else:
+            f.write("  <Genres/>\n")
+
+        f.write(element("OwnerUserId", owner, "  "))
+
+        paths = iter(paths)
+        first = next(paths, None)
+        if first is None:
+            f.write("  <PlaylistItems/>\n")
+        else:
+            f.write("  <PlaylistItems>\n")
+            for path in itertools.chain([first], paths):
+                f.write(f"    <PlaylistItem>\n      <Path>{escape(path)}</Path>\n    </PlaylistItem>\n")
+                count += 1
+            f.write("  </PlaylistItems>\n")
+
+        f.write("  <Shares/>\n")
+        f.write(element("PlaylistMediaType", "Audio", "  "))
+        f.write("</Item>\n")
+    return count
+
+def write_playlist_xml_minidom(output_path, title, paths, running_time="", genres=(), owner="", added=None):
+    """The previous way: build an ElementTree, write it, then re-read and re-indent it with minidom."""
+    import xml.dom.minidom as minidom
+
+    if added is None:
+        added = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
+    playlist = ET.Element("Item")
+    ET.SubElement(playlist, "Added").text = added
+    ET.SubElement(playlist, "LockData").text = "false"
+    ET.SubElement(playlist, "LocalTitle").text = title
+    ET.SubElement(playlist, "RunningTime").text = running_time
+    genres_element = ET.SubElement(playlist, "Genres")
+    for genre in genres:
+        ET.SubElement(genres_element, "Genre").text = genre
+    ET.SubElement(playlist, "OwnerUserId").text = owner
+    playlist_items_element = ET.SubElement(playlist, "PlaylistItems")
+    for path in paths:
+        playlist_item = ET.SubElement(playlist_items_element, "PlaylistItem")
+        ET.SubElement(playlist_item, "Path").text = path
+    ET.SubElement(playlist, "Shares")
+    ET.SubElement(playlist, "PlaylistMediaType").text = "Audio"
+
+    with open(output_path, 'wb') as xml_file:
+        ET.ElementTree(playlist).write(xml_file, encoding="utf-8", xml_declaration=True)
+
+    with open(output_path, 'r', encoding='utf-8') as file:
+        raw_xml = file.read()
+    pretty_xml = minidom.parseString(raw_xml).toprettyxml(indent="  ")
+    pretty_xml = pretty_xml.replace("<?xml version=\"1.0\" ?>", "<?xml version=\"1.0\" encoding=\"utf-8\" standalone=\"yes\"?>")
+    with open(output_path, 'w', encoding='utf-8') as file:
+        file.write(pretty_xml)
+
+def benchmark(items=20000, repeats=3):
+    """Time both writers on a synthetic playlist and check they produce the same file."""
+    paths = [f"/data/music/Artist {i % 300} & Co/Song <{i}> \"live\".flac" for i in range(items)]
+    arguments = dict(title="Benchmark", running_time="1234", genres=["Alternative", "Indie"],
+                     owner="9af58ec9f8c04f008565bd49fead9193", added="01/01/2025 00:00:00")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        outputs = {}
+        for name, writer in (("minidom", write_playlist_xml_minidom), ("streaming", write_playlist_xml)):
+            output_path = os.path.join(temp_dir, f"{name}.xml")
+            best = float("inf")
+            for _ in range(repeats):
+                start = time.perf_counter()
+                writer(output_path, paths=iter(paths), **arguments)
+                best = min(best, time.perf_counter() - start)
+            with open(output_path, 'rb') as f:
+                outputs[name] = f.read()
+            print(f"{name}: {best * 1000:.1f} ms for {items} items")
+
+    print("Outputs identical" if outputs["minidom"] == outputs["streaming"] else "Outputs DIFFER")
+
+def main():
+    parser = argparse.ArgumentParser(description="Jellyfin playlist XML writer.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    benchmark_parser = subparsers.add_parser("benchmark", help="Compare with the ElementTree + minidom writer")
+    benchmark_parser.add_argument("--items", type=int, default=20000)
+    benchmark_parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.items, args.repeats)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#persistent catalog of the music library (path, size, mtime, format, tags, duration, hash) in SQLite
+#refreshing only re-reads files whose size or modification time changed, so the other tools can
+#look files up by artist, album or normalized file name instead of walking the disk every run
+#usage: python library_catalog.py refresh <music folder> | query --artist NAME | stats
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import mutagen
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.expanduser("~"), ".music_catalog.sqlite")
+MUSIC_EXTENSIONS = ('.m4a', '.mp3', '.flac', '.aac', '.wav', '.opus')
+CATALOG_VERSION = 1  # Bump when the schema changes; an older catalog is rebuilt from scratch
+CATALOG_FIELDS = ["path", "size", "mtime_ns", "format", "artist", "album", "title", "genre",
+                  "duration", "hash", "norm_name", "error"]
+
+def normalize_filename(filename):
+    """Remove artist prefix like 'Artist - ' for normalization purposes."""
+    return re.sub(r'^[^/\\]* -  ', '', filename).lower()
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """blake2b of the file contents."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def iter_music_files(root):
+    """Yield (path, stat) for every music file under root, using os.scandir so no extra stat calls are needed."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(MUSIC_EXTENSIONS):
+                        try:
+                            yield entry.path, entry.stat()
+                        except OSError:
+                            continue
+        except OSError as e:
+            print(f"Could not read {directory}: {e}")
+
+def read_file_record(file_path, stat, with_hash=False):
+    """
+    Catalog row for one file. Files mutagen can't read are still recorded, with the error,
+    so they aren't retried until they change.
+    """
+    record = dict.fromkeys(CATALOG_FIELDS)
+    record.update(path=file_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                  format=os.path.splitext(file_path)[1][1:].lower(),
+                  norm_name=normalize_filename(os.path.basename(file_path)))
+    try:
+        audio = mutagen.File(file_path, easy=True)
+        if audio is not None:
+            if audio.tags is not None:
+                for key in ("artist", "album", "title", "genre"):
+                    record[key] = audio.get(key, [None])[0]
+            if audio.info is not None:
+                record["duration"] = getattr(audio.info, "length", None)
+        if with_hash:
+            record["hash"] = file_hash(file_path)
+    except Exception as e:
+        record["error"] = str(e) or type(e).__name__
+    return record
+
+class LibraryCatalog:
+    """
+    SQLite catalog of music files shared by the music_code tools.
+
+    Only use an instance from the thread that created it; refresh() reads tags
+    on worker threads but does all database work itself.
+    """
+
+    def __init__(self, db_path=DEFAULT_CATALOG_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != CATALOG_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS files")
+            self.conn.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, format TEXT, "
+            "artist TEXT, album TEXT, title TEXT, genre TEXT, duration REAL, "
+            "hash TEXT, norm_name TEXT, error TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_artist ON files (artist COLLATE NOCASE)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_album ON files (album COLLATE NOCASE)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_norm_name ON files (norm_name)")
+        self.conn.commit()
+
+    def refresh(self, root, workers=8, with_hash=False):
+        """
+        Bring the catalog up to date with the files under root.
+
+        Unchanged files (same size and mtime) are skipped, changed and new ones are
+        re-read on a thread pool, and rows for files that are gone are deleted.
+        Returns counts of what was done.
+        """
+        start = time.perf_counter()
+        root = os.path.abspath(root)
+        known = {row["path"]: row for row in self.conn.execute(
+            "SELECT path, size, mtime_ns, hash FROM files WHERE path >= ? AND path < ?", self._prefix_range(root))}
+
+        seen = set()
+        changed = []
+        for file_path, stat in iter_music_files(root):
+            seen.add(file_path)
+            row = known.get(file_path)
+            if (row and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns
+                    and (row["hash"] or not with_hash)):
+                continue
+            changed.append((file_path, stat))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            records = executor.map(lambda item: read_file_record(item[0], item[1], with_hash), changed)
+            with self.conn:
+                self.conn.executemany(
+                    f"INSERT OR REPLACE INTO files ({', '.join(CATALOG_FIELDS)}) "
+                    f"VALUES ({', '.join(':' + field for field in CATALOG_FIELDS)})",
+                    records
+                )
+
+        removed = [(path,) for path in known if path not in seen]
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", removed)
+
+        return {"files": len(seen), "read": len(changed), "removed": len(removed),
+                "seconds": time.perf_counter() - start}
+
+    def refresh_files(self, file_paths, workers=8, chunk_size=1000):
+        """
+        Catalog rows for individual files (e.g. the tracks of a playlist), in the order given.
+
+        Files are handled a chunk at a time: rows that are still current come straight from
+        the catalog, the rest are read on a thread pool and stored. Files that don't exist
+        are left out. Works as a generator, so any number of paths can be passed.
+        """
+        file_paths = iter(file_paths)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = list(itertools.islice(file_paths, chunk_size))
+                if not batch:
+                    return
+                chunk = []
+                for file_path in batch:
+                    file_path = os.path.abspath(file_path)
+                    try:
+                        chunk.append((file_path, os.stat(file_path)))
+                    except OSError:
+                        continue
+                if not chunk:
+                    continue
+
+                known = {row["path"]: dict(row) for row in self.conn.execute(
+                    f"SELECT * FROM files WHERE path IN ({', '.join('?' * len(chunk))})", [path for path, _ in chunk])}
+                changed = [(path, stat) for path, stat in chunk
+                           if path not in known or (known[path]["size"], known[path]["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns)]
+                records = list(executor.map(lambda item: read_file_record(item[0], item[1]), changed))
+                with self.conn:
+                    self.conn.executemany(
+                        f"INSERT OR REPLACE INTO files ({', '.join(CATALOG_FIELDS)}) "
+                        f"VALUES ({', '.join(':' + field for field in CATALOG_FIELDS)})",
+                        records
+                    )
+                known.update((record["path"], record) for record in records)
+                for path, _ in chunk:
+                    yield known[path]
+
+    def _prefix_range(self, root):
+        # Paths under root sort between root + separator and that followed by the highest character
+        prefix = os.path.join(os.path.abspath(root), '')
+        return prefix, prefix + '\U0010ffff'
+
+    def _query(self, where="", params=()):
+        sql = "SELECT * FROM files" + (f" WHERE {where}" if where else "") + " ORDER BY path"
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def get(self, file_path):
+        row = self.conn.execute("SELECT * FROM files WHERE path = ?", (os.path.abspath(file_path),)).fetchone()
+        return dict(row) if row else None
+
+    def files(self, root=None, formats=None):
+        """All cataloged files, or those under root, in path order. formats limits the extensions, e.g. ('mp3', 'flac')."""
+        where, params = [], []
+        if root:
+            where.append("path >= ? AND path < ?")
+            params.extend(self._prefix_range(root))
+        if formats:
+            where.append(f"format IN ({', '.join('?' * len(formats))})")
+            params.extend(formats)
+        return self._query(" AND ".join(where), params)
+
+    def by_artist(self, artist):
+        return self._query("artist = ? COLLATE NOCASE", (artist,))
+
+    def by_album(self, album):
+        return self._query("album = ? COLLATE NOCASE", (album,))
+
+    def find_by_name(self, filename, root=None):
+        """Files whose name matches filename after normalize_filename (so 'Artist -  Song.mp3' finds 'Song.mp3')."""
+        norm_name = normalize_filename(os.path.basename(filename))
+        if root:
+            return self._query("norm_name = ? AND path >= ? AND path < ?", (norm_name, *self._prefix_range(root)))
+        return self._query("norm_name = ?", (norm_name,))
+
+    def stats(self):
+        row = self.conn.execute(
+            "SELECT COUNT(*) AS files, COUNT(DISTINCT artist) AS artists, COUNT(DISTINCT album) AS albums, "
+            "COALESCE(SUM(size), 0) AS bytes, COUNT(error) AS errors FROM files"
+        ).fetchone()
+        return dict(row)
+
+    def close(self):
+        self.conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Catalog of the music library shared by the music_code tools.")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="SQLite catalog file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    refresh_parser = subparsers.add_parser("refresh", help="Add new and changed files, drop deleted ones")
+    refresh_parser.add_argument("root", help="Music folder")
+    refresh_parser.add_argument("--workers", type=int, default=8, help="Threads reading tags")
+    refresh_parser.add_argument("--hash", action="store_true", help="Also hash file contents (reads every file)")
+
+    query_parser = subparsers.add_parser("query", help="Look files up")
+    query_parser.add_argument("--artist")
+    query_parser.add_argument("--album")
+    query_parser.add_argument("--name", help="File name, matched after removing an 'Artist - ' prefix")
+
+    subparsers.add_parser("stats", help="Show catalog totals")
+    args = parser.parse_args()
+
+    catalog = LibraryCatalog(args.catalog)
+    try:
+        if args.command == "refresh":
+            result = catalog.refresh(args.root, args.workers, args.hash)
+            print(f"{result['files']} files: {result['read']} read, {result['removed']} removed "
+                  f"in {result['seconds']:.2f} s")
+        elif args.command == "query":
+            if args.artist:
+                rows = catalog.by_artist(args.artist)
+            elif args.album:
+                rows = catalog.by_album(args.album)
+            elif args.name:
+                rows = catalog.find_by_name(args.name)
+            else:
+                parser.error("query needs --artist, --album or --name")
+            for row in rows:
+                print(f"{row['artist']} - {row['album']} - {row['title']} ({row['path']})")
+        else:
+            for key, value in catalog.stats().items():
+                print(f"{key}: {value}")
+    finally:
+        catalog.close()
+
+if __name__ == "__main__":
+    main()
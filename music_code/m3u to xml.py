@@ -1,81 +1,150 @@
-import os
-import xml.etree.ElementTree as ET
-from datetime import datetime
-
-# Updated function
-
-def convert_m3u_to_xml(input_folder, jellyfin_path, owner):
-    m3u_files = []
-    for (path, directories, files) in os.walk(input_folder):
-        for file in files:
-            if file.endswith(".m3u"):
-                m3u = os.path.join(path, file)
-                playlist_name = os.path.splitext(os.path.basename(m3u))[0]
-                
-                # Create the root Item element
-                playlist = ET.Element("Item")
-                
-                # Add sub-elements with proper formatting
-                ET.SubElement(playlist, "Added").text = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-                ET.SubElement(playlist, "LockData").text = "false"
-                ET.SubElement(playlist, "LocalTitle").text = playlist_name
-                ET.SubElement(playlist, "RunningTime").text = "365"
-
-                # Genres element
-                genres = ET.SubElement(playlist, "Genres")
-                ET.SubElement(genres, "Genre").text = "Alternative"
-                ET.SubElement(genres, "Genre").text = "Indie"
-
-                ET.SubElement(playlist, "OwnerUserId").text = owner
-
-                # PlaylistItems element
-                playlist_items_element = ET.SubElement(playlist, "PlaylistItems")
-                
-                with open(m3u, 'r', encoding='utf-8') as file:
-                    for line in file:
-                        line = line.strip()  # Remove trailing whitespace or newlines
-                        if line:  # Skip empty lines
-                            relative_path = line.replace('\\', '/')  # Ensure proper path formatting
-                            playlist_item = ET.SubElement(playlist_items_element, "PlaylistItem")
-                            ET.SubElement(playlist_item, "Path").text = f"{jellyfin_path}/{relative_path}"
-
-                ET.SubElement(playlist, "Shares")
-                ET.SubElement(playlist, "PlaylistMediaType").text = "Audio"
-
-                # Write XML to file with pretty formatting
-                tree = ET.ElementTree(playlist)
-                os.makedirs(os.path.join(input_folder, 'XML Playlists', playlist_name), exist_ok=True)
-                output_folder = os.path.join(input_folder, 'XML Playlists', playlist_name)
-                xml_output_path = os.path.join(output_folder, 'playlist.xml')
-
-                with open(xml_output_path, 'wb') as xml_file:
-                    tree.write(xml_file, encoding="utf-8", xml_declaration=True)
+#converts every .m3u under a folder to a Jellyfin playlist.xml in <folder>/XML Playlists/<name>/
+#playlists are converted in parallel, and ones whose playlist.xml is newer than the .m3u are skipped
+#usage: python "m3u to xml.py" <m3u folder> [--music-folder PATH] [--jellyfin-path PATH] [--owner ID] [--workers N] [--force]
 
-                # Reformat the XML to include indentation
-                reformat_xml(xml_output_path)
-
-                print(f"XML playlist generated at {xml_output_path}")
-
-
-def reformat_xml(file_path):
-    """Reformats the XML file with proper indentation and standalone attribute."""
-    import xml.dom.minidom as minidom
-
-    with open(file_path, 'r', encoding='utf-8') as file:
-        raw_xml = file.read()
-
-    dom = minidom.parseString(raw_xml)
-    pretty_xml = dom.toprettyxml(indent="  ")
-
-    # Add standalone="yes" to the XML declaration
-    if "<?xml version=" in pretty_xml:
-        pretty_xml = pretty_xml.replace("<?xml version=\"1.0\" ?>", "<?xml version=\"1.0\" encoding=\"utf-8\" standalone=\"yes\"?>")
-
-    with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(pretty_xml)
-
-# Example usage
-input_folder = "C:/Users/Caleb/Desktop/m3u"
-jellyfin_path = "/data/rachels_music"
-owner_ID = '2957cc453ab64a2bad36f71b7196b1d4'
-convert_m3u_to_xml(input_folder, jellyfin_path, owner_ID)
+import os
+import time
+import sqlite3
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from jellyfin_xml import write_playlist_xml, playlist_metadata
+from library_catalog import LibraryCatalog, DEFAULT_CATALOG_PATH
+
+DEFAULT_INPUT_FOLDER = "C:/Users/Caleb/Desktop/m3u"
+DEFAULT_MUSIC_FOLDER = "C:/Users/Caleb/Desktop/Rachel_Music"  # The music as this computer sees it
+DEFAULT_JELLYFIN_PATH = "/data/rachels_music"  # The same folder as Jellyfin sees it
+DEFAULT_OWNER_ID = '2957cc453ab64a2bad36f71b7196b1d4'
+
+def m3u_entries(file):
+    """
+    (relative path, length in seconds or None) for the entries in an open .m3u file, one at a time.
+    Handles extended M3U: #EXTM3U and other # lines are skipped, and the length from an
+    #EXTINF line is kept for the entry that follows it.
+    """
+    duration = None
+    for line in file:
+        line = line.strip().lstrip('\ufeff')  # Remove trailing whitespace or newlines (and a BOM)
+        if not line:  # Skip empty lines
+            continue
+        if line.startswith('#'):
+            if line.upper().startswith('#EXTINF:'):
+                try:
+                    duration = float(line[8:].split(',', 1)[0].split()[0])
+                except (ValueError, IndexError):
+                    duration = None
+                if duration is not None and duration < 0:
+                    duration = None  # -1 means unknown length
+            continue
+        yield line.replace('\\', '/'), duration  # Ensure proper path formatting
+        duration = None
+
+def playlist_tracks(catalog, entries, base_folder, chunk_size=1000):
+    """
+    Catalog rows for the entries of a playlist, found relative to base_folder. Tracks missing
+    from disk fall back to their #EXTINF length so RunningTime is still close.
+    """
+    entries = iter(entries)
+    while True:
+        chunk = [(os.path.abspath(os.path.join(base_folder, entry)), duration)
+                 for entry, duration in itertools.islice(entries, chunk_size)]
+        if not chunk:
+            return
+        rows = {row["path"]: row for row in catalog.refresh_files((path for path, _ in chunk), workers=2)}
+        for path, duration in chunk:
+            yield rows.get(path) or {"duration": duration}
+
+def convert_playlist(m3u, xml_root, jellyfin_path, owner, music_folder=None, catalog_path=DEFAULT_CATALOG_PATH,
+                     force=False):
+    """
+    Convert one .m3u to xml_root/<name>/playlist.xml.
+    Entries are relative to the music folder: jellyfin_path in the XML, music_folder (the local copy,
+    or the .m3u's own folder if None) when reading the tracks' lengths and genres.
+    Skipped (unless force) if that playlist.xml is newer than the .m3u.
+    Returns (xml path, number of items or None if skipped, RunningTime).
+    """
+    playlist_name = os.path.splitext(os.path.basename(m3u))[0]
+    output_folder = os.path.join(xml_root, playlist_name)
+    xml_output_path = os.path.join(output_folder, 'playlist.xml')
+
+    if not force:
+        try:
+            if os.path.getmtime(xml_output_path) >= os.path.getmtime(m3u):
+                return xml_output_path, None, ""
+        except OSError:
+            pass  # No playlist.xml yet
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Each conversion opens its own catalog connection, as SQLite connections can't be shared between threads
+    catalog = LibraryCatalog(catalog_path)
+    try:
+        with open(m3u, 'r', encoding='utf-8') as file:
+            # First pass: total length and genres of the tracks, found in the local music folder
+            tracks = playlist_tracks(catalog, m3u_entries(file), music_folder or os.path.dirname(m3u))
+            running_time, genres = playlist_metadata(tracks)
+
+            # Second pass: lines are streamed straight into the indented, standalone XML file
+            file.seek(0)
+            paths = (f"{jellyfin_path}/{entry}" for entry, _ in m3u_entries(file))
+            count = write_playlist_xml(xml_output_path, playlist_name, paths,
+                                       running_time=running_time, genres=genres, owner=owner)
+    finally:
+        catalog.close()
+    return xml_output_path, count, running_time
+
+def convert_m3u_to_xml(input_folder, jellyfin_path, owner, workers=4, force=False, catalog_path=DEFAULT_CATALOG_PATH,
+                       music_folder=None):
+    """
+    Convert every .m3u under input_folder, workers playlists at a time.
+    Track lengths and genres come from the library catalog, which reads new or changed
+    files' stream info concurrently and remembers it for the next run.
+    """
+    start = time.perf_counter()
+    xml_root = os.path.join(input_folder, 'XML Playlists')
+    m3u_files = [
+        os.path.join(path, file)
+        for path, _, files in os.walk(input_folder)
+        for file in files if file.lower().endswith(".m3u")
+    ]
+
+    converted = skipped = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert_playlist, m3u, xml_root, jellyfin_path, owner, music_folder,
+                                   catalog_path, force): m3u
+                   for m3u in m3u_files}
+        for future in as_completed(futures):
+            try:
+                xml_output_path, count, running_time = future.result()
+            except (OSError, UnicodeDecodeError, sqlite3.Error) as e:  # e.g. the catalog locked by another writer
+                print(f"Failed to convert {futures[future]}: {e}")
+                failed += 1
+                continue
+            if count is None:
+                skipped += 1
+                continue
+            converted += 1
+            print(f"XML playlist generated at {xml_output_path} ({count} items, {running_time or '?'} min)")
+
+    print(f"{converted} converted, {skipped} up to date, {failed} failed "
+          f"in {time.perf_counter() - start:.2f} s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert .m3u playlists to Jellyfin playlist.xml files.")
+    parser.add_argument("input_folder", nargs="?", default=DEFAULT_INPUT_FOLDER, help="Folder searched for .m3u files")
+    parser.add_argument("--music-folder", default=DEFAULT_MUSIC_FOLDER,
+                        help="Local music folder the entries are relative to, for track lengths and genres")
+    parser.add_argument("--jellyfin-path", default=DEFAULT_JELLYFIN_PATH,
+                        help="Music folder as Jellyfin sees it; playlist entries are relative to it")
+    parser.add_argument("--owner", default=DEFAULT_OWNER_ID, help="Jellyfin user ID that owns the playlists")
+    parser.add_argument("--workers", type=int, default=4, help="Playlists converted at the same time")
+    parser.add_argument("--force", action="store_true", help="Rewrite playlist.xml files that are up to date")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="SQLite catalog file")
+    args = parser.parse_args()
+
+    convert_m3u_to_xml(args.input_folder, args.jellyfin_path.rstrip('/'), args.owner,
+                       workers=args.workers, force=args.force, catalog_path=args.catalog,
+                       music_folder=args.music_folder)
+
+if __name__ == "__main__":
+    main()
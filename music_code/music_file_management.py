@@ -1,86 +1,83 @@
 #looks through directory and sub-directories for music files and creates a dictionary
-#prompts if you want to remove leading numbers with periods, underscores,or hyphens (e.g. 02. music.mp3)
-#prompts if you want to remove artist names/album names from the file name (matches with file metadata)
+#renames files using the rules in rename_rules.json, e.g. removes leading numbers with periods, underscores,or hyphens (e.g. 02. music.mp3)
+#and artist names/album names from the file name (matches with file metadata)
 #generates a few text files of changes made to files + a list of all files after renaming
+#usage: python music_file_management.py <music folder> [<music folder> ...] [--dry-run] [--skip album] [--rollback]
 
 import os
 import re
+import json
+import time
+import functools
+import argparse
+from datetime import datetime
 from tkinter import Tk
 from tkinter.filedialog import askdirectory
 import xml.etree.ElementTree as ET
-import mutagen
 from mutagen.easyid3 import EasyID3
 from mutagen.flac import FLAC
 from mutagen.mp4 import MP4
 from mutagen.oggopus import OggOpus
 from mutagen.aac import AAC
+from library_catalog import LibraryCatalog, DEFAULT_CATALOG_PATH
 
 file_types = ['m4a','mp3','flac','aac','wav','opus']
 
-def get_music(input_folder): #makes dictionary of music files in folders and subfolders (gets path, artist, title)
+ext_pattern = r"|".join([re.escape(ext) for ext in file_types])
+txt_pat = r"\s?-?_?\s?" #matches with hypen or underscore
+rules_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rename_rules.json')
 
-    music_info = {}
-    ID = 0
+def get_music(input_folder, catalog_path=DEFAULT_CATALOG_PATH, workers=8): #makes dictionary of music files in folders and subfolders (gets path, artist, title)
 
-    if os.path.isfile('skipped.txt'):
-        skipped_txt = open('skipped.txt','w')
-    else:
-        skipped_txt = open('skipped.txt','x')
-
-    for (path, directories, files) in os.walk(input_folder): #get music info and create dictionary
-        for file in files:
-            for type in file_types: # checks extensions in types (iterate as .endswith only accepts one at a time)
-                if file.endswith(type):
-                    ID = ID + 1
-                    file_path = os.path.join(path,file)
-                    try:
-                        file_info = mutagen.File(file_path, easy=True)
-                    except: # tip: you can get error as variable if you put "Exception as variable" after ""except"
-                        print(f'Skipping file {os.path.basename(file)}')
-                        skipped_txt.write(f'{file_path}\n')
-
-                    try:
-                        title = file_info.get('title', [None])[0]
-                        artist = file_info.get('artist', [None])[0]
-                        album = file_info.get('album', [None])[0]
-                    except:
-                        print(f"Missing info for {file_path}")
-
-                    music_info[ID] = {'file_path':file_path,\
-                                          'title': title, 'artist':artist, \
-                                            'album':album}
+    # tags come from the shared library catalog, which only re-reads files whose size or modification time changed
+    # input_folder can also be a list of folders, which end up in one dictionary
+    input_folders = [input_folder] if isinstance(input_folder, str) else input_folder
+    music_info = {}
+    records = []
+    read = found = 0
+    catalog = LibraryCatalog(catalog_path)
+    try:
+        for folder in input_folders:
+            refresh = catalog.refresh(folder, workers)
+            read, found = read + refresh['read'], found + refresh['files']
+            records.extend(catalog.files(folder, file_types))
+    finally:
+        catalog.close()
 
+    ID = 0
+    with open('skipped.txt', 'w') as skipped_txt:
+        for record in records:
+            if record['error']:
+                print(f"Skipping file {os.path.basename(record['path'])}")
+                skipped_txt.write(f"{record['path']}\n")
+                continue
+            ID = ID + 1
+            music_info[ID] = {'file_path':record['path'],\
+                                  'title': record['title'], 'artist':record['artist'], \
+                                    'album':record['album']}
+
+    print(f"{ID} music files ({read} read, {found - read} from catalog)")
     return music_info
 
-def change_file_names(music_info):
-
-    #text patterns
-    ext_pattern = r"|".join([re.escape(ext) for ext in file_types])
-    left_pat = r"^" #only matches beginning of file name
-    n_pat = r"[0-9]+" #beginning of leading numbers match
-    n_pat1 = left_pat + n_pat + r"\s-\s" #matches numbers with hyphens and spaces
-    n_pat2 = left_pat + n_pat + r"\.\s?"r"(?!(" + ext_pattern + r")$)" #negative lookahead (?!...) ensures period is not followed by extension
-    n_pat3 = left_pat + n_pat + r"\s?_\s?" #matches numbers with underscores
-    n_pat4 = r"\s-\s" + n_pat + r"\s-\s"
-    n_pat5 = r"_" + n_pat + r"_"
-    n_pat6 = left_pat + n_pat + r"\s+"
-    txt_pat = r"\s?-?_?\s?" #matches with hypen or underscore
-
-    if input("Remove artist names from files (Y/N): ") == "Y" or "y":
-        music_info = remove_artist_names(music_info,txt_pat)
-    else:
-        None
-
-    if input("Remove album names from files (Y/N): ") == "Y" or "y":
-        music_info = remove_album_names(music_info,txt_pat)
-    else:
-        None
-
-    if input("Remove leading numbers from files (Y/N): ") == "Y" or "y":
-        music_info = remove_leading_numbers(music_info,n_pat1,n_pat2,n_pat3,n_pat4,n_pat5,n_pat6)
-    else:
-        None
-    
+def change_file_names(music_info, rules, dry_run=False, journal_path='rename_journal.json'):
+
+    plan, collisions = plan_renames(music_info, rules)
+    rename_report_txt(plan, 'artist', 'artists')
+    rename_report_txt(plan, 'album', 'albums')
+    if collisions:
+        print(f'{len(collisions)} files not renamed because the new name is taken (see rename_collisions.txt)')
+        with open('rename_collisions.txt', 'w') as collisions_txt:
+            for ID, old_path, new_path in collisions:
+                collisions_txt.write(f'{old_path} -->\n{new_path}\n\n')
+
+    if dry_run:
+        with open('rename_plan.txt', 'w') as plan_txt:
+            for entry in plan:
+                plan_txt.write(f"{entry['old']} -->\n{entry['new']}\n\n")
+        print('Dry run, nothing renamed (see rename_plan.txt)')
+        return
+
+    apply_rename_plan(plan, music_info, journal_path)
     all_files_txt(music_info)
 
 def all_files_txt(music_info):
@@ -104,123 +101,178 @@ def all_files_txt(music_info):
         all_files_txt.write(f'{file}\n')
     all_files_txt.close()
 
-def remove_leading_numbers(music_info,n_pat1,n_pat2,n_pat3,n_pat4,n_pat5,n_pat6): #removes leading numbers from file name if it exists
-
-    for ID, info in music_info.items():
-        full_path = info['file_path']
-        path_to_file = os.path.dirname(full_path)
-        file_name = os.path.basename(full_path)
-        title = info['title']
-
-        if re.search(n_pat1, file_name):
-            preview_name = re.sub(n_pat1, '', file_name)  # Simulate the rename
-        elif re.search(n_pat2, file_name):
-            preview_name = re.sub(n_pat2, '', file_name)  # Simulate the rename
-        elif re.search(n_pat3, file_name):
-            preview_name = re.sub(n_pat3, '', file_name)  # Simulate the rename
-        elif re.search(n_pat4, file_name):
-            preview_name = re.sub(n_pat4, ' - ', file_name)  # Simulate the rename
-        elif re.search(n_pat5, file_name):
-            preview_name = re.sub(n_pat5, ' - ', file_name)  # Simulate the rename
-        elif re.search(n_pat6, file_name):
-            preview_name = re.sub(n_pat6, '', file_name)
+def load_rules(rules_file=rules_path, skip=()): #reads the rule file and compiles every pattern once
+
+    with open(rules_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    separator = config.get('separator', txt_pat)
+
+    rules = []
+    for rule in config['rules']:
+        if rule['name'] in skip or not rule.get('enabled', True):
+            continue
+        if 'strip_prefix' in rule:
+            rules.append({'name': rule['name'], 'field': rule['strip_prefix'],
+                          'unless_in': rule.get('unless_in'), 'separator': separator})
+        elif 'replace' in rule:
+            sources = [pattern.replace('{ext}', ext_pattern) for pattern, replacement in rule['replace']]
+            # one combined matcher per rule: the first alternative whose pattern is found anywhere in the
+            # name wins, the same as trying the patterns one after another
+            matcher = re.compile(r"^(?:" + r"|".join(f"(?=.*?(?P<p{i}>{source}))" for i, source in enumerate(sources)) + r")")
+            patterns = [(re.compile(source), replacement) for source, (_, replacement) in zip(sources, rule['replace'])]
+            rules.append({'name': rule['name'], 'matcher': matcher, 'patterns': patterns})
         else:
-            preview_name = file_name  # No changes required
-  
-        try:
-            new_path = os.path.join(path_to_file, preview_name)
-            os.rename(full_path, new_path)  # Rename the file
-            info['file_path'] = new_path  # Update the file path in the dictionary
-        except:
-            None
+            raise ValueError(f"Rule {rule['name']} needs either strip_prefix or replace")
+    return rules
+
+@functools.lru_cache(maxsize=None)
+def prefix_pattern(text, separator=txt_pat): #artist/album name at the start of a file name, compiled once per distinct name
+
+    return re.compile(re.escape(text) + separator)
+
+def plan_file_name(info, rules): #new file name after applying the rules in order, and the names of the rules that changed it
+
+    file_name = os.path.basename(info['file_path'])
+    steps = []
+
+    for rule in rules:
+        if 'field' in rule:
+            text = info.get(rule['field'])
+            if not text:
+                continue
+            if rule['unless_in'] and (not info.get(rule['unless_in']) or text in info[rule['unless_in']]):
+                continue #e.g. the album name is part of the title (the title track)
+            match = prefix_pattern(text, rule['separator']).match(file_name)
+            if not match:
+                continue
+            new_name = file_name[match.end():]
+        else:
+            match = rule['matcher'].match(file_name)
+            if not match:
+                continue
+            pattern, replacement = rule['patterns'][int(match.lastgroup[1:])]
+            new_name = pattern.sub(replacement, file_name)
 
-    return music_info
+        if new_name != file_name and os.path.splitext(new_name)[0].strip(): #never strip the whole name
+            file_name = new_name
+            steps.append(rule['name'])
 
-def remove_artist_names(music_info,txt_pat): #removes artists names from file name if it exists 
+    return file_name, steps
 
-    changed_artist_files = []
-    txt_name = "artists"
+def path_key(path): #OneDrive folders are case-insensitive, so compare paths that way
 
-    for ID, info in music_info.items():
-        full_path = info['file_path']
-        path_to_file,file_name = os.path.dirname(full_path),os.path.basename(full_path)
-        re_artist = info['artist']
-        try:
-            re_artist = re_artist + txt_pat
-        except:
-            re_artist = "zzzzzzzzzzzzzz"
-        match = re.match(re_artist, file_name)
-
-        if match:
-            new_file_name = re.sub(re_artist, '', file_name) #change file_name to one without pattern
-            new_path = os.path.join(path_to_file, new_file_name)
-            os.rename(full_path,new_path)
-            #print(f'"{file_name}" CHANGED TO "{new_file_name}"')
-            changed_artist_files.append(f'{file_name} -->\n{new_file_name}\n')
-            info['file_path'] = new_path
-    
-    try:
-        removed_artists_txt = open(f'removed_{txt_name}.txt', 'x')
-    except:
-        removed_artists_txt = open(f'removed_{txt_name}.txt', 'w')
-
-    for l in changed_artist_files:
-        removed_artists_txt.write(f'{l}\n')
-    
-    removed_artists_txt.close()
+    return os.path.normcase(path).casefold()
 
-    return music_info
-
-def remove_album_names(music_info,txt_pat): #removes album names from file name if it exists
+def plan_renames(music_info, rules):
 
-    changed_album_files = []
-    txt_name = "albums"
+    # one pass over all files; nothing is renamed yet. a rename is left out of the plan if its new
+    # name already exists in the folder or is the new name of another file
+    start = time.perf_counter()
+    plan = []
+    collisions = []
+    targets = set()
+    folder_contents = {} #folder -> names in it, listed once per folder instead of checking each file
 
     for ID, info in music_info.items():
-
-        full_path = info['file_path']
-        path_to_file, file_name = os.path.dirname(full_path),os.path.basename(full_path)
-        re_album = info['album']
+        old_path = info['file_path']
+        new_name, steps = plan_file_name(info, rules)
+        if not steps:
+            continue
+
+        folder = os.path.dirname(old_path)
+        new_path = os.path.join(folder, new_name)
+        if folder not in folder_contents:
+            try:
+                folder_contents[folder] = {name.casefold() for name in os.listdir(folder)}
+            except OSError:
+                folder_contents[folder] = set()
+
+        key = path_key(new_path)
+        case_only = key == path_key(old_path)
+        if key in targets or (not case_only and new_name.casefold() in folder_contents[folder]):
+            collisions.append((ID, old_path, new_path))
+            continue
+        targets.add(key)
+        plan.append({'id': ID, 'old': old_path, 'new': new_path, 'steps': steps})
+
+    print(f'Planned {len(music_info)} files in {time.perf_counter() - start:.2f} s: '
+          f'{len(plan)} renames, {len(collisions)} collisions')
+    return plan, collisions
+
+def apply_rename_plan(plan, music_info, journal_path='rename_journal.json'):
+
+    # the whole plan is written to the journal before anything is renamed, so rollback_renames
+    # can undo the batch even if this run is interrupted
+    start = time.perf_counter()
+    with open(journal_path, 'w', encoding='utf-8') as journal:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'),
+                   'renames': [[entry['old'], entry['new']] for entry in plan]}, journal)
+
+    renamed = 0
+    failed = []
+    for entry in plan:
+        old_path, new_path = entry['old'], entry['new']
         try:
-            re_album = re_album + txt_pat
-        except:
-            re_album = "zzzzzzzzzzzzzzzzzzzzzz"
-
-        try: 
-            if info['album'] in info['title']:
-                re_album = "zzzzzzzzzzzzzzzzzzzzzz"
-                #print(f"{full_path} --> File name is the same as the album, skipping...")
-        except:
-            re_album = "zzzzzzzzzzzzzzzzzzzzzz"
-
-        match = re.match(re_album, file_name)
-
-        if match:
-            new_file_name = re.sub(re_album, '', file_name) #change file_name to one without pattern
-            new_path = os.path.join(path_to_file, new_file_name)
-            os.rename(full_path,new_path)
-            #print(f'"{file_name}" CHANGED TO "{new_file_name}"')
-            changed_album_files.append(f'{file_name} -->\n{new_file_name}\n')
-            info['file_path'] = new_path
-        else:
-            None
-    try:
-        removed_albums_txt = open(f'removed_{txt_name}.txt', 'x')
-    except:
-        removed_albums_txt = open(f'removed_{txt_name}.txt', 'w')
-
-    for l in changed_album_files:
-        removed_albums_txt.write(f'{l}\n')
-    
-    removed_albums_txt.close()
-
-    return music_info
+            if os.path.exists(new_path) and path_key(new_path) != path_key(old_path): #appeared since planning
+                raise FileExistsError(f'{new_path} already exists')
+            os.rename(old_path, new_path)
+            music_info[entry['id']]['file_path'] = new_path
+            renamed = renamed + 1
+        except OSError as e:
+            print(f"Couldn't rename {old_path}: {e}")
+            failed.append((old_path, new_path))
+
+    print(f'Renamed {renamed} files in {time.perf_counter() - start:.2f} s ({len(failed)} failed), journal: {journal_path}')
+    return failed
+
+def rollback_renames(journal_path='rename_journal.json', music_info=None): #undoes the renames recorded by apply_rename_plan
+
+    with open(journal_path, 'r', encoding='utf-8') as journal:
+        renames = json.load(journal)['renames']
+
+    restored = {}
+    for old_path, new_path in reversed(renames):
+        # only files that were actually renamed (and not replaced since) are moved back
+        if os.path.exists(new_path) and (not os.path.exists(old_path) or path_key(old_path) == path_key(new_path)):
+            try:
+                os.rename(new_path, old_path)
+                restored[new_path] = old_path
+            except OSError as e:
+                print(f"Couldn't restore {old_path}: {e}")
+
+    if music_info:
+        for info in music_info.values():
+            info['file_path'] = restored.get(info['file_path'], info['file_path'])
+
+    print(f'Restored {len(restored)} of {len(renames)} files from {journal_path}')
+    return restored
+
+def rename_report_txt(plan, step, txt_name): #removed_artists.txt / removed_albums.txt listing the renames that step took part in
+
+    with open(f'removed_{txt_name}.txt', 'w') as report_txt:
+        for entry in plan:
+            if step in entry['steps']:
+                report_txt.write(f"{os.path.basename(entry['old'])} -->\n{os.path.basename(entry['new'])}\n\n")
 
 def main():
-    path = "/Users/calebmueller/Library/CloudStorage/OneDrive-UNBC/Music/Rachel_Music"
-    music_info = get_music(path)
-    change_file_names(music_info)
+    parser = argparse.ArgumentParser(description="Rename music files using the rules in rename_rules.json.")
+    parser.add_argument("roots", nargs="*", help="Music folders, all renamed in one batch",
+                        default=["/Users/calebmueller/Library/CloudStorage/OneDrive-UNBC/Music/Rachel_Music"])
+    parser.add_argument("--rules", default=rules_path, help="Rule file")
+    parser.add_argument("--skip", action="append", default=[], metavar="RULE", help="Leave out a rule by name (repeatable)")
+    parser.add_argument("--dry-run", action="store_true", help="Only write the plan to rename_plan.txt")
+    parser.add_argument("--rollback", action="store_true", help="Undo the renames recorded in the journal")
+    parser.add_argument("--journal", default="rename_journal.json", help="Rename journal file")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="Library catalog file")
+    args = parser.parse_args()
+
+    if args.rollback:
+        rollback_renames(args.journal)
+        return
+
+    rules = load_rules(args.rules, args.skip)
+    music_info = get_music(args.roots, args.catalog)
+    change_file_names(music_info, rules, args.dry_run, args.journal)
 
 if __name__ == "__main__":
     main()
-
@@ -1,99 +1,232 @@
 import os
+import json
+import time
+import errno
 import shutil
-import xml.etree.ElementTree as ET
-from datetime import datetime
-from mutagen.easyid3 import EasyID3
-from mutagen.flac import FLAC
-from mutagen.mp4 import MP4
-from mutagen.oggopus import OggOpus
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tkinter import Tk
 from tkinter.filedialog import askdirectory
+from library_catalog import LibraryCatalog, file_hash
+from jellyfin_xml import write_playlist_xml, playlist_metadata
 
-def get_artist(file_path):
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # Linux ioctl that makes dest a copy-on-write clone of src
+MANIFEST_NAME = ".organize_manifest.jsonl"
+LINK_METHODS = ("hardlink", "symlink")  # Build the layout without copying any data
+
+def reflink(src, dest):
     """
-    Extract artist metadata from an audio file.
-    Supports .mp3, .flac, .m4a, and .opus formats.
+    Copy-on-write clone of src at dest (Linux FICLONE: btrfs, XFS, ...), which takes no
+    extra space until either file changes. Raises OSError if the filesystem can't.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dest)
+
+def place_file(src, dest, method="copy"):
     """
+    Put src at dest using method ("copy", "reflink", "hardlink" or "symlink").
+    Reflinks, hardlinks and symlinks fall back to a normal copy when the filesystem (or
+    crossing filesystems) doesn't allow them. The file only appears at dest once complete.
+    Returns the method actually used.
+    """
+    temp_path = dest + ".part"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)  # Left over from an interrupted run
+    used = "copy"
     try:
-        if file_path.lower().endswith('.mp3'):
-            audio = EasyID3(file_path)
-            return audio.get('artist', [None])[0]
-        elif file_path.lower().endswith('.flac'):
-            audio = FLAC(file_path)
-            return audio.get('artist', [None])[0]
-        elif file_path.lower().endswith('.m4a'):
-            audio = MP4(file_path)
-            return audio.tags.get('\xa9ART', [None])[0]  # MP4 artist tag
-        elif file_path.lower().endswith('.opus'):
-            audio = OggOpus(file_path)
-            return audio.get('artist', [None])[0]
-    except Exception as e:
-        print(f"Error reading {file_path}: {e}")
-    return None
-
-def copy_and_organize_music(input_folder, output_folder):
+        if method == "hardlink":
+            os.link(src, temp_path)
+            used = "hardlink"
+        elif method == "symlink":
+            # Relative, so the layout keeps working if the library is mounted somewhere else (e.g. in Jellyfin's container)
+            os.symlink(os.path.relpath(src, os.path.dirname(dest)), temp_path)
+            used = "symlink"
+        elif method == "reflink":
+            reflink(src, temp_path)
+            used = "reflink"
+    except (OSError, ValueError):  # ValueError: no relative path between Windows drives
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+    if used == "copy":
+        shutil.copy2(src, temp_path)  # copy2 keeps the modification time, so the next run can skip the file
+    os.replace(temp_path, dest)
+    return used
+
+def is_same_file(src, dest, src_size, src_mtime_ns, verify="size", method="copy"):
+    """
+    True if dest already holds src: size and modification time match, or with verify="hash" the contents do.
+    For the link methods only a link to src counts, so an earlier full copy gets replaced by a link.
+    """
+    try:
+        dest_stat = os.stat(dest)
+    except OSError:
+        return False
+    if os.path.samefile(src, dest):
+        # Hardlink or symlink from an earlier run: kept only if that kind of link was asked for,
+        # so a copy run turns the links back into independent copies
+        return method == ("symlink" if os.path.islink(dest) else "hardlink")
+    if method in LINK_METHODS:
+        return False
+    if dest_stat.st_size != src_size:
+        return False
+    if verify == "hash":
+        return file_hash(src) == file_hash(dest)
+    # Filesystems differ in timestamp precision (FAT, SMB shares), so allow a couple of seconds
+    return abs(dest_stat.st_mtime_ns - src_mtime_ns) < 2_000_000_000
+
+def load_manifest(manifest_path):
+    """Files placed by earlier runs: {dest: (src size, src mtime_ns, method asked for)}."""
+    done = {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Last line of a run that was killed mid-write
+                done[entry["dest"]] = (entry["size"], entry["mtime_ns"], entry.get("method", "copy"))
+    except OSError:
+        pass
+    return done
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+def copy_and_organize_music(input_folder, output_folder, catalog=None, workers=4, method="copy", verify="size",
+                            tracks=None):
     """
     Copy and organize music files into folders by artist.
+    Artists come from the library catalog, which only re-reads tags of new or changed files.
+
+    Files are copied by a pool of workers threads. Files already at the destination (same
+    size and modification time, or same contents with verify="hash") are skipped, and every
+    finished file is recorded in a manifest in output_folder, so an interrupted run picks up
+    where it stopped. method "reflink" or "hardlink" avoids copying the data when input and
+    output are on the same filesystem.
+
+    method "hardlink" or "symlink" builds the artist folders as a virtual layout that uses
+    no extra space (falling back to copies across filesystems); the returned playlist items
+    are relative to output_folder, so playlists written there point at the links.
+
+    If a list is passed as tracks, the catalog row of each playlist item is appended to it.
     """
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
     playlist_items = []
 
-    for root, _, files in os.walk(input_folder):
-        for file in files:
-            if file.lower().endswith(('.mp3', '.flac', '.m4a', '.opus')):
-                file_path = os.path.join(root, file)
-                artist = get_artist(file_path)
-                if artist:
-                    artist_folder = os.path.join(output_folder, artist)
-                    if not os.path.exists(artist_folder):
-                        os.makedirs(artist_folder)
-                    dest_path = os.path.join(artist_folder, file)
-                    shutil.copy(file_path, dest_path)
-                    print(f"Copied {file} to {artist_folder}")
-
-                    # Add relative path to playlist
-                    relative_path = f"{artist}/{file}"
-                    playlist_items.append(relative_path)
-                else:
-                    print(f"Artist metadata not found for {file_path}")
+    if catalog is None:
+        catalog = LibraryCatalog()
+    catalog.refresh(input_folder)
+
+    # Plan every copy first, creating each artist folder once
+    jobs = []
+    destinations = set()
+    artist_folders = set()
+    for record in catalog.files(input_folder, ('mp3', 'flac', 'm4a', 'opus')):
+        file_path = record['path']
+        file = os.path.basename(file_path)
+        artist = record['artist']
+        if record['error']:
+            print(f"Error reading {file_path}: {record['error']}")
+        if artist:
+            artist_folder = os.path.join(output_folder, artist)
+            if artist_folder not in artist_folders:
+                os.makedirs(artist_folder, exist_ok=True)
+                artist_folders.add(artist_folder)
+            dest_path = os.path.join(artist_folder, file)
+            relative_path = f"{artist}/{file}"
+            if dest_path in destinations:
+                print(f"Skipping {file_path}: {relative_path} is already used by another file")
+                continue
+            destinations.add(dest_path)
+
+            # Add relative path to playlist
+            playlist_items.append(relative_path)
+            if tracks is not None:
+                tracks.append(record)
+            jobs.append((file_path, dest_path, record['size'], record['mtime_ns']))
+        else:
+            print(f"Artist metadata not found for {file_path}")
+
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    done = load_manifest(manifest_path)
+
+    def place(job):
+        file_path, dest_path, size, mtime_ns = job
+        previous = done.get(dest_path)
+        # A link run doesn't trust files placed by a copy run (or the other link kind) and the other way around
+        same_kind = previous and (previous[2] if previous[2] in LINK_METHODS else "copy") == \
+            (method if method in LINK_METHODS else "copy")
+        if same_kind and previous[:2] == (size, mtime_ns) and os.path.exists(dest_path):
+            return "skipped"
+        if is_same_file(file_path, dest_path, size, mtime_ns, verify, method):
+            return "skipped"
+        return place_file(file_path, dest_path, method)
+
+    total_bytes = sum(job[2] for job in jobs)
+    counts = {}
+    done_bytes = 0
+    start = last_report = time.perf_counter()
+    with open(manifest_path, 'a', encoding='utf-8') as manifest, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(place, job): job for job in jobs}
+        for future in as_completed(futures):
+            file_path, dest_path, size, mtime_ns = futures[future]
+            try:
+                result = future.result()
+            except OSError as e:
+                print(f"Failed to copy {file_path}: {e}")
+                result = "failed"
+            else:
+                if result == "copy" and method != "copy" and "copy" not in counts:
+                    print(f"Could not {method} {file_path} (different filesystem?), copying instead")
+                if result != "skipped":
+                    manifest.write(json.dumps({"dest": dest_path, "size": size, "mtime_ns": mtime_ns, "method": method}) + "\n")
+                    manifest.flush()
+            counts[result] = counts.get(result, 0) + 1
+            done_bytes += size
+
+            now = time.perf_counter()
+            if now - last_report >= 2 or done_bytes == total_bytes:
+                elapsed = now - start
+                rate = done_bytes / elapsed if elapsed else 0
+                eta = (total_bytes - done_bytes) / rate if rate else 0
+                print(f"{sum(counts.values())}/{len(jobs)} files, {done_bytes / 1e6:.0f}/{total_bytes / 1e6:.0f} MB, "
+                      f"{rate / 1e6:.1f} MB/s, ETA {format_duration(eta)}")
+                last_report = now
+
+    elapsed = time.perf_counter() - start
+    summary = ", ".join(f"{count} {result}" for result, count in sorted(counts.items()))
+    print(f"Placed {len(jobs)} files in {format_duration(elapsed)} ({summary or 'nothing to do'})")
 
     return playlist_items
 
-def generate_xml_playlist(playlist_items, input_folder_name, output_folder):
+def generate_xml_playlist(playlist_items, input_folder_name, output_folder, tracks=()):
     """
     Generate an XML playlist with the given items.
+    RunningTime and genres are worked out from tracks, the catalog rows of the items.
     """
-    playlist = ET.Element("Item")
-    
-    # Add metadata elements
-    ET.SubElement(playlist, "Added").text = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-    ET.SubElement(playlist, "LockData").text = "false"
-    ET.SubElement(playlist, "LocalTitle").text = input_folder_name
-    ET.SubElement(playlist, "RunningTime").text = "366"
-    
-    genres = ET.SubElement(playlist, "Genres")
-    ET.SubElement(genres, "Genre").text = "Alternative"
-    ET.SubElement(genres, "Genre").text = "Indie"
-    # Add additional genres as needed
-
-    ET.SubElement(playlist, "OwnerUserId").text = "9af58ec9f8c04f008565bd49fead9193"
-
-    # Add playlist items
-    playlist_items_element = ET.SubElement(playlist, "PlaylistItems")
-    for item in playlist_items:
-        playlist_item = ET.SubElement(playlist_items_element, "PlaylistItem")
-        ET.SubElement(playlist_item, "Path").text = f"/data/music/{item}"
-
-    ET.SubElement(playlist, "Shares")
-    ET.SubElement(playlist, "PlaylistMediaType").text = "Audio"
-
-    # Write XML to file
-    tree = ET.ElementTree(playlist)
+    running_time, genres = playlist_metadata(tracks)
     xml_output_path = os.path.join(output_folder, f'{input_folder_name}.xml')
-    tree.write(xml_output_path, encoding="utf-8", xml_declaration=True)
-    print(f"XML playlist generated at {xml_output_path}")
+    write_playlist_xml(
+        xml_output_path,
+        input_folder_name,
+        (f"/data/music/{item}" for item in playlist_items),
+        running_time=running_time,
+        genres=genres,
+        owner="9af58ec9f8c04f008565bd49fead9193",
+    )
+    print(f"XML playlist generated at {xml_output_path} ({running_time or '?'} min)")
 
 def generate_m3u_playlist(playlist_items, input_folder_name, output_folder):
     """
@@ -105,10 +238,11 @@ def generate_m3u_playlist(playlist_items, input_folder_name, output_folder):
             m3u_file.write(f"{item}\n")
     print(f"M3U playlist generated at {m3u_output_path}")
 
-def folder_process():
-    Tk().withdraw()  # Hide the main Tkinter window
-    print("Select the folder containing the music files:")
-    input_folder = askdirectory(title="Select Input Folder")
+def folder_process(input_folder=None):
+    if not input_folder:
+        Tk().withdraw()  # Hide the main Tkinter window
+        print("Select the folder containing the music files:")
+        input_folder = askdirectory(title="Select Input Folder")
     if not input_folder:
         print("No input folder selected. Exiting.")
         exit()
@@ -122,11 +256,23 @@ def folder_process():
     return input_folder, input_name, output_folder
 
 def main():
-    input_folder, input_name, output_folder = folder_process()
+    parser = argparse.ArgumentParser(description="Copy music into artist folders and generate playlists.")
+    parser.add_argument("input_folder", nargs="?", help="Music folder (asks with a dialog if left out)")
+    parser.add_argument("--workers", type=int, default=4, help="Files copied at the same time")
+    parser.add_argument("--method", choices=("copy", "reflink", "hardlink", "symlink"), default="copy",
+                        help="reflink/hardlink avoid copying data on the same filesystem, hardlink/symlink build "
+                             "the artist folders without using extra space (all fall back to copy)")
+    parser.add_argument("--verify", choices=("size", "hash"), default="size",
+                        help="How to tell a file at the destination is already up to date")
+    args = parser.parse_args()
+
+    input_folder, input_name, output_folder = folder_process(args.input_folder)
     print(f"Organizing music from {input_folder} to {output_folder}...")
-    playlist_items = copy_and_organize_music(input_folder, output_folder)
+    tracks = []
+    playlist_items = copy_and_organize_music(input_folder, output_folder, workers=args.workers,
+                                             method=args.method, verify=args.verify, tracks=tracks)
     print("Generating XML playlist...")
-    generate_xml_playlist(playlist_items, input_name, output_folder)
+    generate_xml_playlist(playlist_items, input_name, output_folder, tracks)
 
     print("Generating M3U playlist...")
     generate_m3u_playlist(playlist_items, input_name, output_folder)